@@ -1,45 +1,99 @@
 #!/usr/bin/env python3
 
-import gc
+import functools
+import itertools
 import os
-import shutil
 import argparse
 import json
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from itertools import combinations
-import collections
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 import oxipng
+import queue
 import sys
 import tempfile
+import threading
 import zipfile
 
-from PIL import Image, ImageChops
+from PIL import Image
+from numba import njit, prange, set_num_threads
 import numpy as np
 
 IMAGE_EXTENSIONS = {'.png'}
+DESCRIPTOR_SIZE = (32, 32)
+DEFAULT_OXIPNG_LEVEL = 4
+IMAGE_CACHE_SIZE = 4
+NEIGHBOR_BLOCK_ROWS = 1024
+OXIPNG_OPTIONS = {'optimize_alpha': True}
+# Decoded images are RGBX with X = 255, so clearing these bits turns a packed pixel fully transparent.
+PIXEL_RGB_MASK = ~np.array([0, 0, 0, 255], dtype=np.uint8).view(np.uint32)[0]
 
 class DisjointSetUnion:
     """A simple Disjoint Set Union (DSU) or Union-Find data structure."""
     def __init__(self, items):
         self.parent = {item: item for item in items}
+        self.rank = {item: 0 for item in self.parent}
 
     def find(self, item):
-        if self.parent[item] == item:
-            return item
-        self.parent[item] = self.find(self.parent[item])
-        return self.parent[item]
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
 
     def union(self, item1, item2):
         root1 = self.find(item1)
         root2 = self.find(item2)
-        if root1 != root2:
-            self.parent[root2] = root1
-            return True
-        return False
+        if root1 == root2:
+            return False
+        if self.rank[root1] < self.rank[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        if self.rank[root1] == self.rank[root2]:
+            self.rank[root1] += 1
+        return True
+
+def walk_images(root):
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield entry.path, entry.stat().st_size
+
+def build_csr(num_nodes, edges):
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    targets = np.concatenate([edges[:, 1], edges[:, 0]])
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=indptr[1:])
+    return indptr, targets[np.argsort(sources, kind='stable')]
+
+@njit(cache=True)
+def bfs(indptr, indices, source, parent_out, node_queue):
+    node_queue[0] = source
+    parent_out[source] = source
+    head, tail = 0, 1
+    while head < tail:
+        node = node_queue[head]
+        head += 1
+        for k in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[k]
+            if parent_out[neighbor] == -1:
+                parent_out[neighbor] = node
+                node_queue[tail] = neighbor
+                tail += 1
+    return node_queue[:tail]
 
 def print_progress_bar(iteration, total, prefix='', suffix='', length=50, fill='█'):
     if total == 0: total = 1
+    if iteration % max(1, total // 200) and iteration != total:
+        return
     percent = f"{100 * (iteration / float(total)):.1f}"
     filled_length = int(length * iteration // total)
     bar = fill * filled_length + '-' * (length - filled_length)
@@ -47,58 +101,134 @@ def print_progress_bar(iteration, total, prefix='', suffix='', length=50, fill='
     if iteration == total:
         print()
 
-def calculate_similarity_score(img_path1, img_path2):
+def compute_descriptor(img):
+    thumb = img.convert('L').resize(DESCRIPTOR_SIZE, Image.Resampling.BILINEAR)
+    return np.asarray(thumb, dtype=np.uint8).ravel()
+
+def decoded_array_path(decoded_dir, image_id):
+    return decoded_dir / f"{image_id}.npy"
+
+def read_image_size(img_path):
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except Exception:
+        return None
+
+def decode_image(img_path, array_path):
+    try:
+        with Image.open(img_path) as img:
+            img_rgb = img.convert('RGB')
+        if array_path is not None:
+            np.save(array_path, np.asarray(img_rgb.convert('RGBX')))
+        return compute_descriptor(img_rgb)
+    except Exception as e:
+        print(f"\nError decoding {os.path.basename(img_path)}: {e}")
+        return None
+
+def nearest_neighbor_pairs(descriptors, image_sizes, k):
+    num_images = len(descriptors)
+    k = min(k, num_images - 1)
+    if k < 1:
+        return np.empty((0, 2), dtype=np.int64)
+    features = descriptors.astype(np.float64)
+    sq_norms = np.einsum('ij,ij->i', features, features)
+    size_groups = np.unique(image_sizes, axis=0, return_inverse=True)[1].ravel()
+    pairs = []
+    for start in range(0, num_images, NEIGHBOR_BLOCK_ROWS):
+        stop = min(start + NEIGHBOR_BLOCK_ROWS, num_images)
+        rows = np.arange(start, stop)
+        distances = features[start:stop] @ features.T
+        distances *= -2
+        distances += sq_norms[start:stop, None]
+        distances += sq_norms[None, :]
+        distances[size_groups[start:stop, None] != size_groups[None, :]] = np.inf
+        distances[rows - start, rows] = np.inf
+        neighbors = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        found = np.isfinite(np.take_along_axis(distances, neighbors, axis=1))
+        pairs.append(np.stack([np.repeat(rows, k)[found.ravel()], neighbors[found]], axis=1))
+    pairs = np.concatenate(pairs)
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+def load_image_array(image_source):
+    if image_source.suffix == '.npy':
+        return np.load(image_source, mmap_mode='r')
+    with Image.open(image_source) as img:
+        return np.asarray(img.convert('RGB').convert('RGBX'))
+
+_cached_image_array = load_image_array
+_oxipng_level = DEFAULT_OXIPNG_LEVEL
+
+def set_image_cache_size(maxsize):
+    global _cached_image_array
+    _cached_image_array = functools.lru_cache(maxsize=maxsize)(load_image_array)
+
+def as_pixels(arr):
+    return arr.view(np.uint32)[..., 0]
+
+@njit(parallel=True, fastmath=True, cache=True)
+def equal_pixel_count(pixels1, pixels2):
+    height, width = pixels1.shape
+    count = 0
+    for i in prange(height):
+        for j in range(width):
+            if pixels1[i, j] == pixels2[i, j]:
+                count += 1
+    return count
+
+@njit(parallel=True, cache=True)
+def build_delta_rgba(current, base, out):
+    height, width = current.shape
+    for i in prange(height):
+        for j in range(width):
+            pixel = current[i, j]
+            out[i, j] = pixel if pixel != base[i, j] else pixel & PIXEL_RGB_MASK
+
+def init_worker(oxipng_level):
+    global _oxipng_level
+    # The process pool already provides the parallelism; keep oxipng and Numba from spawning their own threads per worker.
+    os.environ['RAYON_NUM_THREADS'] = '1'
+    set_num_threads(1)
+    set_image_cache_size(IMAGE_CACHE_SIZE)
+    _oxipng_level = oxipng_level
+
+def calculate_similarity_score(image_source1, image_source2):
     try:
-        with Image.open(img_path1) as img1, Image.open(img_path2) as img2:
-            if img1.size != img2.size or img1.mode != img2.mode:
-                img2 = img2.resize(img1.size).convert(img1.mode)
-            
-            diff = ImageChops.difference(img1, img2)
-            diff_arr = np.array(diff.convert('L'))
-            non_zero_pixels = np.count_nonzero(diff_arr)
-            total_pixels = diff_arr.shape[0] * diff_arr.shape[1]
-            return total_pixels - non_zero_pixels
+        arr1, arr2 = _cached_image_array(image_source1), _cached_image_array(image_source2)
+        if arr1.shape != arr2.shape:
+            return -1
+        return equal_pixel_count(as_pixels(arr1), as_pixels(arr2))
     except Exception:
         return -1
 
-def process_image(current_img_path, base_img_path, output_path):
+def process_image(current_source, base_source, image_path_rel):
     try:
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        with Image.open(current_img_path) as img_current, Image.open(base_img_path) as img_base:
-            img_current_rgb = img_current.convert('RGB')
-            del img_current
-            img_base_rgb = img_base.convert('RGB')
-            del img_base
-            diff = ImageChops.difference(img_current_rgb, img_base_rgb)
-            del img_base_rgb
-            mask = diff.convert('L').point(lambda p: 255 if p > 0 else 0)
-            del diff
-            sanitized_image = img_current_rgb.convert('RGBA')
-            del img_current_rgb
-            sanitized_image.putalpha(mask)
-            del mask
-            rgba_array = np.array(sanitized_image, dtype=np.uint8)
-            height, width, channels = rgba_array.shape
-            del sanitized_image
-            data = rgba_array.tobytes()
-            del rgba_array
-            color_type = oxipng.ColorType.rgba()  
-            raw = oxipng.RawImage(data, width, height, color_type=color_type)
-            del data, color_type
-            optimized = raw.create_optimized_png(level=6, optimize_alpha=True)
-            del raw
-            with open(output_path, "wb") as f:
-              f.write(optimized)
-            del optimized
-        gc.collect()
-        return True
+        current_rgbx = load_image_array(current_source)
+        base_rgbx = load_image_array(base_source)
+        if current_rgbx.shape != base_rgbx.shape:
+            raise ValueError("images do not match")
+        height, width, _ = current_rgbx.shape
+        rgba_array = np.empty((height, width, 4), dtype=np.uint8)
+        build_delta_rgba(as_pixels(current_rgbx), as_pixels(base_rgbx), as_pixels(rgba_array))
+        data = rgba_array.tobytes()
+        color_type = oxipng.ColorType.rgba()
+        raw = oxipng.RawImage(data, width, height, color_type=color_type)
+        return raw.create_optimized_png(level=_oxipng_level, **OXIPNG_OPTIONS)
     except Exception as e:
-        gc.collect()
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         print(f"\nException: {exc_type} in {fname} at line {exc_tb.tb_lineno}")
-        print(f"Error processing {os.path.basename(str(current_img_path))}: {e}")
-        return False
+        print(f"Error processing {os.path.basename(image_path_rel)}: {e}")
+        return None
+
+def write_archive_entries(zipf, entries, errors):
+    # Keep draining after a failure so the producer never blocks on a full queue.
+    while (entry := entries.get()) is not None:
+        if not errors:
+            try:
+                zipf.writestr(*entry)
+            except Exception as e:
+                errors.append(e)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -106,8 +236,15 @@ def main():
         formatter_class=argparse.RawTextHelpFormatter
     )
     parser.add_argument("input_dir", help="Directory containing source images and subdirectories.")
-    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() // 2, help="Number of concurrent threads.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() // 2, help="Number of worker processes.")
+    parser.add_argument("-k", "--neighbors", type=int, default=8, help="Number of nearest neighbors scored per image.")
+    parser.add_argument("--oxipng-level", type=int, default=DEFAULT_OXIPNG_LEVEL, choices=range(7), help="oxipng optimization level for delta images.")
+    parser.add_argument("--max-cache-mb", type=int, default=4096, help="Temp space for decoded images; images past it are decoded from the PNG when needed.")
     args = parser.parse_args()
+    if args.neighbors < 1:
+        parser.error("--neighbors must be at least 1")
+    if args.max_cache_mb < 0:
+        parser.error("--max-cache-mb must not be negative")
 
     input_dir = Path(args.input_dir).resolve()
     output_zip_path = Path(f"{input_dir}.dia")
@@ -116,12 +253,15 @@ def main():
         print(f"Error: Input directory not found at '{input_dir}'")
         return
 
+    worker_pool = functools.partial(ProcessPoolExecutor, max_workers=args.workers, initializer=init_worker, initargs=(args.oxipng_level,))
+
     with tempfile.TemporaryDirectory() as temp_dir:
-        output_dir = Path(temp_dir)
+        decoded_dir = Path(temp_dir) / "decoded"
+        decoded_dir.mkdir()
 
         print("Scanning for images recursively...")
-        all_image_paths_abs = [p for p in input_dir.rglob('**/*') if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS]
-        image_paths_rel = [str(p.relative_to(input_dir)) for p in all_image_paths_abs]
+        file_sizes = {os.path.relpath(path, input_dir): size for path, size in walk_images(input_dir)}
+        image_paths_rel = list(file_sizes)
         try:
             image_paths_rel.sort(key=lambda f: int(Path(f).stem))
         except (ValueError, IndexError):
@@ -131,87 +271,111 @@ def main():
             print("At least two images are required for optimization.")
             return
 
-        path_to_id = {path: str(i) for i, path in enumerate(image_paths_rel)}
-        id_to_path = {str(i): path for i, path in enumerate(image_paths_rel)}
+        num_images = len(image_paths_rel)
+        sizes = np.array([file_sizes[path] for path in image_paths_rel], dtype=np.int64)
 
-        print(f"Found {len(image_paths_rel)} images. Starting Phase 1: Scoring all pairs...")
-        all_pairs = list(combinations(image_paths_rel, 2))
-        all_scores = []
-        with ThreadPoolExecutor(max_workers=args.workers) as executor:
-            future_to_pair = {executor.submit(calculate_similarity_score, input_dir / p[0], input_dir / p[1]): p for p in all_pairs}
-            for i, future in enumerate(as_completed(future_to_pair), 1):
-                pair = future_to_pair[future]
+        print(f"Found {num_images} images. Starting Phase 1: Decoding images...")
+        image_paths_abs = [input_dir / p for p in image_paths_rel]
+        descriptors = np.empty((num_images, DESCRIPTOR_SIZE[0] * DESCRIPTOR_SIZE[1]), dtype=np.uint8)
+        image_sizes = np.zeros((num_images, 2), dtype=np.int64)
+        is_decoded = np.zeros(num_images, dtype=bool)
+        with worker_pool() as executor:
+            for i, image_size in enumerate(executor.map(read_image_size, image_paths_abs, chunksize=64)):
+                if image_size is not None:
+                    image_sizes[i] = image_size
+            decoded_bytes = image_sizes.prod(axis=1) * 4
+            is_cached = (np.cumsum(decoded_bytes) <= args.max_cache_mb * 2**20) & (decoded_bytes > 0)
+            image_sources = [decoded_array_path(decoded_dir, i) if is_cached[i] else path for i, path in enumerate(image_paths_abs)]
+            array_paths = [source if is_cached[i] else None for i, source in enumerate(image_sources)]
+            for i, descriptor in enumerate(executor.map(decode_image, image_paths_abs, array_paths)):
+                if descriptor is not None:
+                    descriptors[i] = descriptor
+                    is_decoded[i] = True
+        if not is_decoded.all():
+            print(f"{num_images - is_decoded.sum()} images could not be decoded and will be stored as-is.")
+        if not is_cached[is_decoded].all():
+            print(f"Decoded cache limit reached; {(is_decoded & ~is_cached).sum()} images will be decoded from PNG when needed.")
+        decoded_ids = np.flatnonzero(is_decoded)
+        candidate_pairs = decoded_ids[nearest_neighbor_pairs(descriptors[decoded_ids], image_sizes[decoded_ids], args.neighbors)]
+
+        print(f"Scoring {len(candidate_pairs)} candidate pairs...")
+        pair_scores = np.full(len(candidate_pairs), -1, dtype=np.int32)
+        with worker_pool() as executor:
+            future_to_index = {executor.submit(calculate_similarity_score, image_sources[i], image_sources[j]): n for n, (i, j) in enumerate(candidate_pairs.tolist())}
+            for done, future in enumerate(as_completed(future_to_index), 1):
+                n = future_to_index[future]
                 try:
-                    score = future.result()
-                    if score != -1:
-                        id1, id2 = path_to_id[pair[0]], path_to_id[pair[1]]
-                        all_scores.append((score, id1, id2))
+                    pair_scores[n] = future.result()
                 except Exception as e:
-                    print(f"\nError scoring pair {pair}: {e}")
-                print_progress_bar(i, len(all_pairs), prefix='Phase 1/2:', suffix='Scoring Pairs')
-
-        all_scores.sort(key=lambda x: x[0], reverse=True)
-        dsu = DisjointSetUnion(id_to_path.keys())
-        adjacency_list = collections.defaultdict(list)
-        for score, u_id, v_id in all_scores:
-            if dsu.union(u_id, v_id):
-                adjacency_list[u_id].append(v_id)
-                adjacency_list[v_id].append(u_id)
-
-        root_image_ids, dependencies_by_id, visited_ids = [], {}, set()
-        for image_id in id_to_path.keys():
-            if image_id not in visited_ids:
-                component_node_ids, q = [], collections.deque([image_id])
-                component_visited_ids = {image_id}
-                while q:
-                    node_id = q.popleft()
-                    component_node_ids.append(node_id)
-                    for neighbor_id in adjacency_list[node_id]:
-                        if neighbor_id not in component_visited_ids:
-                            component_visited_ids.add(neighbor_id)
-                            q.append(neighbor_id)
-                optimal_root_id = min(component_node_ids, key=lambda nid: (input_dir / id_to_path[nid]).stat().st_size)
-                root_image_ids.append(optimal_root_id)
-                q = collections.deque([optimal_root_id])
-                visited_ids.add(optimal_root_id)
-                while q:
-                    parent_id = q.popleft()
-                    for child_id in adjacency_list[parent_id]:
-                        if child_id not in visited_ids:
-                            visited_ids.add(child_id)
-                            dependencies_by_id[child_id] = parent_id
-                            q.append(child_id)
-
-        map_data = {"image_map": id_to_path, "root_images": sorted(root_image_ids, key=int), "dependencies": dependencies_by_id}
-        map_file_path = output_dir / "optimization_map.json"
-        with open(map_file_path, 'w', encoding='utf-8') as f:
-            json.dump(map_data, f, indent=2, sort_keys=True, ensure_ascii=False)
-        print(f"\nOptimization map created in temporary directory.")
-
-        print("Starting Phase 2: Processing images...")
-        for root_id in root_image_ids:
-            root_path_rel = id_to_path[root_id]
-            dest_path = output_dir / root_path_rel
-            dest_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(input_dir / root_path_rel, dest_path)
-        
-        total_to_process = len(dependencies_by_id) + len(root_image_ids)
-        processed_count = len(root_image_ids)
-        print_progress_bar(processed_count, total_to_process, prefix='Phase 2/2:', suffix='Processing')
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(process_image, input_dir / id_to_path[cid], input_dir / id_to_path[pid], output_dir / id_to_path[cid]): cid for cid, pid in dependencies_by_id.items()}
-            for future in as_completed(futures):
-                if future.result():
-                    processed_count += 1
-                    print_progress_bar(processed_count, total_to_process, prefix='Phase 2/2:', suffix='Processing')
-        
-        print("\nZipping output files...")
-        with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in output_dir.rglob('*'):
-                if file_path.is_file():
-                    arcname = file_path.relative_to(output_dir)
-                    zipf.write(file_path, arcname)
-    
+                    i, j = candidate_pairs[n]
+                    print(f"\nError scoring pair {(image_paths_rel[i], image_paths_rel[j])}: {e}")
+                print_progress_bar(done, len(candidate_pairs), prefix='Phase 1/2:', suffix='Scoring Pairs')
+
+        scored = np.flatnonzero(pair_scores != -1)
+        order = scored[np.argsort(-pair_scores[scored], kind='stable')]
+        dsu = DisjointSetUnion(range(num_images))
+        tree_edges = [(u, v) for u, v in candidate_pairs[order].tolist() if dsu.union(u, v)]
+        indptr, indices = build_csr(num_images, np.array(tree_edges, dtype=np.int64).reshape(-1, 2))
+
+        components = np.full(num_images, -1, dtype=np.int32)
+        parents = np.full(num_images, -1, dtype=np.int32)
+        bfs_queue = np.empty(num_images, dtype=np.int32)
+        for image_id in range(num_images):
+            if components[image_id] == -1:
+                component_arr = bfs(indptr, indices, image_id, components, bfs_queue)
+                bfs(indptr, indices, component_arr[sizes[component_arr].argmin()], parents, bfs_queue)
+        is_root = parents == np.arange(num_images)
+        root_image_ids, dependent_ids = np.flatnonzero(is_root).tolist(), np.flatnonzero(~is_root).tolist()
+
+        map_data = {
+            "image_map": {str(i): path for i, path in enumerate(image_paths_rel)},
+            "root_images": [str(i) for i in root_image_ids],
+            "dependencies": {str(i): str(parents[i]) for i in dependent_ids},
+        }
+        partial_zip_path = output_zip_path.with_name(output_zip_path.name + '.partial')
+        try:
+            with zipfile.ZipFile(partial_zip_path, 'w', zipfile.ZIP_STORED) as zipf:
+                zipf.writestr("optimization_map.json", json.dumps(map_data, indent=2, sort_keys=True, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+                print(f"\nOptimization map written to archive.")
+
+                print("Starting Phase 2: Processing images...")
+                for root_id in root_image_ids:
+                    zipf.write(input_dir / image_paths_rel[root_id], image_paths_rel[root_id])
+
+                total_to_process = num_images
+                processed_count = len(root_image_ids)
+                print_progress_bar(processed_count, total_to_process, prefix='Phase 2/2:', suffix='Processing')
+                entries, write_errors = queue.Queue(maxsize=args.workers * 2), []
+                writer = threading.Thread(target=write_archive_entries, args=(zipf, entries, write_errors))
+                writer.start()
+                try:
+                    with worker_pool() as executor:
+                        # Submit in a bounded window so finished deltas cannot pile up in their futures.
+                        pending_ids = iter(dependent_ids)
+                        def submit(cid):
+                            return executor.submit(process_image, image_sources[cid], image_sources[parents[cid]], image_paths_rel[cid])
+                        futures = {submit(cid): cid for cid in itertools.islice(pending_ids, args.workers * 2)}
+                        while futures and not write_errors:
+                            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                cid = futures.pop(future)
+                                optimized = future.result()
+                                if optimized is not None:
+                                    entries.put((image_paths_rel[cid], optimized))
+                                    processed_count += 1
+                                    print_progress_bar(processed_count, total_to_process, prefix='Phase 2/2:', suffix='Processing')
+                                next_cid = next(pending_ids, None)
+                                if next_cid is not None:
+                                    futures[submit(next_cid)] = next_cid
+                finally:
+                    entries.put(None)
+                    writer.join()
+                if write_errors:
+                    raise write_errors[0]
+            os.replace(partial_zip_path, output_zip_path)
+        finally:
+            partial_zip_path.unlink(missing_ok=True)
+
     print(f"Optimization complete. Output saved to {output_zip_path}")
 
 if __name__ == "__main__":